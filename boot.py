@@ -9,14 +9,20 @@ version = 1.2
 import network
 import time
 import gc
-import os
 from machine import freq
 
-freq(160000000)
+# Frecuencia maxima: la descarga OTA (TLS) y el loop asyncio van limitados por CPU
+freq(240000000)
 
 # --- Configuracion de OTA ---
 GITHUB_URL = "https://raw.githubusercontent.com/mrocca2012/project/master/"
 
+# Espera maxima de conexion por cada red
+WIFI_CONNECT_TIMEOUT_MS = 10000
+
+# --- IP fija (ip, mascara, gateway, dns) ---
+STATIC_IFCONFIG = ('192.168.68.10', '255.255.255.0', '192.168.68.1', '192.168.68.1')
+
 def connect_to_wifi():
     """
     Conecta el ESP32 a la red Wi-Fi probando múltiples credenciales.
@@ -31,38 +37,40 @@ def connect_to_wifi():
     print("Iniciando conexión Wi-Fi para OTA...")
     wlan = network.WLAN(network.STA_IF)
     wlan.active(True)
-    wlan.ifconfig(('192.168.68.10', '255.255.255.0', '192.168.68.1', '192.168.68.1'))
-    
-    if wlan.isconnected():
-        print(f"✅ Wi-Fi ya conectado. IP: {wlan.ifconfig()[0]}")
-        return True
-
-    for ssid, password in WIFI_CREDENTIALS:
-        print(f"📡 Intentando conectar a: {ssid}...")
-        
-        wlan.connect(ssid, password)
-        
-        # Tiempo de espera (timeout) por red
-        timeout = 15
-        while not wlan.isconnected() and timeout > 0:
-            time.sleep(1)
-            timeout -= 1
-        
+    # Reintentos acotados solo durante el arranque, para pasar rapido a la siguiente red
+    wlan.config(reconnects=5)
+    try:
         if wlan.isconnected():
-            print(f"✅ Wi-Fi conectado a '{ssid}'. IP: {wlan.ifconfig()[0]}")
+            print(f"✅ Wi-Fi ya conectado. IP: {wlan.ifconfig()[0]}")
+            wlan.ifconfig(STATIC_IFCONFIG)
             return True
-        else:
-            print(f"❌ Falló la conexión a '{ssid}'. Tiempo agotado.")
-            # Desconectar y/o desactivar brevemente para limpiar el estado antes de la próxima
-            wlan.disconnect() 
-            time.sleep(1) # Esperar un segundo antes de probar la siguiente red
 
-    print("❌ Error de conexión Wi-Fi. No se pudo conectar a ninguna red.")
-    return False
+        for ssid, password in WIFI_CREDENTIALS:
+            print(f"📡 Intentando conectar a: {ssid}...")
+            
+            wlan.connect(ssid, password)
+            
+            # El driver reintenta por su cuenta (reconnects); esperamos con un limite propio
+            deadline = time.ticks_add(time.ticks_ms(), WIFI_CONNECT_TIMEOUT_MS)
+            while wlan.status() == network.STAT_CONNECTING and time.ticks_diff(deadline, time.ticks_ms()) > 0:
+                time.sleep(0.1)
+            
+            if wlan.isconnected():
+                print(f"✅ Wi-Fi conectado a '{ssid}'. IP: {wlan.ifconfig()[0]}")
+                # IP fija despues de asociar, para que DHCP no la sobrescriba
+                wlan.ifconfig(STATIC_IFCONFIG)
+                return True
+            else:
+                print(f"❌ Falló la conexión a '{ssid}'. Tiempo agotado.")
+                # Desconectar y/o desactivar brevemente para limpiar el estado antes de la próxima
+                wlan.disconnect() 
+                time.sleep(1) # Esperar un segundo antes de probar la siguiente red
 
-# Ejemplo de uso (opcional, si estás probando):
-# if __name__ == '__main__':
-#     connect_to_wifi()
+        print("❌ Error de conexión Wi-Fi. No se pudo conectar a ninguna red.")
+        return False
+    finally:
+        # main.py no reconecta por su cuenta: dejar al driver reintentando para siempre (por defecto)
+        wlan.config(reconnects=-1)
 
 def check_for_updates():
     """Verifica y ejecuta la actualizacion OTA."""
@@ -70,6 +78,7 @@ def check_for_updates():
     if not connect_to_wifi():
         return False     
     try:
+        gc.collect()
         import ota
         updater = ota.OTAUpdater(GITHUB_URL, main_file='main.py')
         
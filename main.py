@@ -5,71 +5,218 @@
 
 version = 1.2
 
-from machine import Pin, time_pulse_us, reset
-import network
+from machine import Pin, reset, disable_irq, enable_irq
+from array import array
+import micropython
+from micropython import const
+try:
+    from machine import Counter # PCNT por hardware (firmware >= 1.25)
+except ImportError:
+    Counter = None
 import time
-import ujson
+import gc
+import struct
+import socket
 import asyncio
-import ntptime
+
+# Buffer para poder reportar excepciones dentro de las ISR (eco y caudal)
+micropython.alloc_emergency_exception_buf(100)
 
 # --- CONFIGURACIÓN ---
 CONFIG_FILE = 'config.json'
-LOG_FILE = 'water_log.json'
-TANK_HEIGHT_CM = 200 
-VALVE_PIN = 18
-MOTOR_PIN = 19
-FLOW_SENSOR_PIN = 17
-TRIG_PIN = 4
-ECHO_PIN = 5
-FLOW_TIMEOUT = 300
-TIMEZONE_OFFSET_HOURS = -4
+LOG_SLOT_FILE = 'log{}.bin'
+LOG_SLOTS = const(8)
+LEGACY_LOG_FILE = 'water_log.json'
+TANK_HEIGHT_CM = const(200)
+VALVE_PIN = const(18)
+MOTOR_PIN = const(19)
+FLOW_SENSOR_PIN = const(17)
+TRIG_PIN = const(4)
+ECHO_PIN = const(5)
+FLOW_TIMEOUT = const(300)
+PING_RETRIES = const(5)
+PING_GUARD_MS = const(3)
+PING_MAX_US = const(29000) # eco mas largo que esto = sin objeto (fuera de rango)
+# Cada cuantos ticks (s) medir el nivel segun el estado
+PING_EVERY_MOTOR = const(1)
+PING_EVERY_VALVE = const(5)
+PING_EVERY_IDLE = const(3)
+MAX_REQUEST_BYTES = const(1024)
+SAVE_DELTA_L = 0.1
+TIMEZONE_OFFSET_HOURS = const(-4)
+NTP_TIMEOUT_S = const(2)
+_TZ_OFFSET_S = const(TIMEZONE_OFFSET_HOURS * 3600)
+_CM_PER_US = 1 / 58.2 # ida y vuelta a 343 m/s; float, no cabe en const()
+
+# Horas de llenado programado (en punto)
+_HOURS_WEEK = frozenset((7, 12, 19))
+_HOURS_WEEKEND = frozenset((8, 12, 19))
 
 NTP_SERVERS = ["3.south-america.pool.ntp.org", "pool.ntp.org", "time.google.com"]
 
+# --- PAGINA WEB (partes estaticas, se envian tal cual en cada GET) ---
+# Cabecera HTTP + <head> con el CSS en un solo bloque de bytes
+HTML_HEAD = b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nConnection: close\r\n\r\n" b"""
+                <html><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1">
+                <style>
+                    body { font-family: sans-serif; text-align: center; background: #f0f2f5; }
+                    .card { background: white; margin: 10px auto; padding: 20px; border-radius: 12px; max-width: 350px; box-shadow: 0 4px 10px rgba(0,0,0,0.1); }
+                    .btn { display: block; width: 100%; padding: 15px; margin: 8px 0; border: none; border-radius: 8px; color: white; font-weight: bold; cursor: pointer; }
+                    .on { background: #28a745; } .off { background: #dc3545; } .reset { background: #6c757d; font-size: 0.8em; }
+                    .bar { background: #eee; border-radius: 10px; height: 20px; }
+                    .fill { background: #007bff; height: 100%; border-radius: 10px; transition: 1s; }
+                    .clock { font-size: 1.2em; color: #333; font-weight: bold; margin-bottom: 15px; }
+                </style></head><body>"""
+
+# Parte dinamica: plantilla con formato % (hora, alerta, nivel, nivel, litros, botones, estado)
+HTML_ALERT = "<div style='color:#155724; background:#d4edda; padding:10px; border-radius:5px; margin-bottom:10px;'>%s</div>"
+HTML_BODY = """
+                    <div class="card">
+                        <div class="clock">🕒 %s</div>
+                        <h2>Control de Agua</h2>
+                        %s
+                        <p>Tanque: %.1f%%</p>
+                        <div class="bar"><div class="fill" style="width: %.1f%%;"></div></div>
+                        <p>Total: %.2f L</p>
+                        <form action="/flow/reset" method="POST"><button type="submit" class="btn reset">RESETEAR CONTADOR</button></form>
+                    </div>
+                    <div class="card">
+                        <form action="/valve/toggle" method="POST"><button class="btn %s">%s</button></form>
+                        <form action="/motor/toggle" method="POST"><button class="btn %s">%s</button></form>
+                    </div>
+                    <p style='font-size:0.7em;'>Estado: %s</p>
+                """
+HTML_TAIL = b"""
+                    <script>setTimeout(()=>{ if(!document.hidden) location.reload(); }, 5000);</script>
+                </body></html>
+                """
+
+# Respuesta fija a los POST: volver a la pagina principal
+HTTP_REDIRECT = b"HTTP/1.1 303 See Other\r\nLocation: /\r\nConnection: close\r\n\r\n"
+
 class SystemController:
     def __init__(self):
         self.config = self.load_config()
+        # Litros por pulso, precalculado para multiplicar en el tick en vez de dividir
+        self.k_factor_inv = 1.0 / float(self.config.get('K_FACTOR', 450.0))
         self.valve = Pin(VALVE_PIN, Pin.OUT, value=1)
         self.motor = Pin(MOTOR_PIN, Pin.OUT, value=1)
         self.trig = Pin(TRIG_PIN, Pin.OUT)
         self.echo = Pin(ECHO_PIN, Pin.IN)
-        self.flow_pin = Pin(FLOW_SENSOR_PIN, Pin.IN, Pin.PULL_DOWN)
+        flow_pin = Pin(FLOW_SENSOR_PIN, Pin.IN, Pin.PULL_DOWN)
+        if Counter:
+            # Contador de pulsos por hardware (PCNT): cuenta sin ISR y con filtro anti-rebote
+            self.flow_counter = Counter(0, flow_pin, edge=Counter.RISING, filter_ns=1000)
+        else:
+            # Sin PCNT: ISR viper sobre un array, sin asignar memoria
+            self.flow_counter = None
+            self._pulse_buf = array('I', [0])
+            flow_pin.irq(trigger=Pin.IRQ_RISING, handler=self._flow_handler)
         
         self.water_level_pct = 0
+        self._seq = 0
         self.liters_total = self.load_liters()
+        self._last_saved = self.liters_total
+        self._dirty = False
         self.pulses = 0
         self.valve_on = False
         self.motor_on = False
         self.alert_msg = ""
         self.valve_open_time = 0
         self.time_synced = False
+        self._fmt_cache = (0, "")
+        self._tick_now = 0
+        self._tick_local = None
+        self._last_checked_minute = -1
         
-        self.flow_pin.irq(trigger=Pin.IRQ_RISING, handler=self._flow_handler)
+        self._last_ping_ms = time.ticks_ms() - PING_GUARD_MS
+        self._ping_tick = PING_EVERY_VALVE # medir ya en el primer tick
+        self._t_rise = 0
+        self._t_fall = 0
+        self._echo_flag = asyncio.ThreadSafeFlag()
+        self._wake = asyncio.Event()
+        # IRQ dura: el ticks_us se toma en el flanco, sin la latencia del scheduler
+        self.echo.irq(trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, handler=self._echo_handler, hard=True)
 
+    @micropython.viper
     def _flow_handler(self, pin):
-        self.pulses += 1
+        p = ptr32(self._pulse_buf)
+        p[0] = p[0] + 1
+
+    def _read_pulses(self):
+        """Lee y reinicia el contador de pulsos (PCNT o ISR)."""
+        if self.flow_counter:
+            # Lectura y reinicio atómicos del contador PCNT
+            return self.flow_counter.value(0)
+        state = disable_irq()
+        n = self._pulse_buf[0]
+        self._pulse_buf[0] = 0
+        enable_irq(state)
+        return n
 
     def load_config(self):
+        import ujson
         try:
             with open(CONFIG_FILE, 'r') as f: return ujson.load(f)
-        except: return {"WIFI_SSID": "WOWIFI", "WIFI_PASS": "fliarorewifi", "K_FACTOR": 450.0}
+        except (OSError, ValueError): return {"WIFI_SSID": "WOWIFI", "WIFI_PASS": "fliarorewifi", "K_FACTOR": 450.0}
 
     def load_liters(self):
-        try:
-            with open(LOG_FILE, 'r') as f: return ujson.load(f).get('total', 0.0)
-        except: return 0.0
+        # Cada slot guarda (secuencia, litros); el de mayor secuencia es el mas reciente
+        liters, found = 0.0, False
+        for slot in range(LOG_SLOTS):
+            try:
+                with open(LOG_SLOT_FILE.format(slot), 'rb') as f:
+                    seq, value = struct.unpack('<Id', f.read(12))
+                # Descartar slots con basura (NaN o negativo) por una escritura a medias
+                if seq >= self._seq and value == value and value >= 0:
+                    self._seq, liters, found = seq, value, True
+            except (OSError, ValueError): continue
+        if not found:
+            # Sin slots validos: migrar una sola vez el log JSON de versiones anteriores
+            # ('total' de main.py 1.2, 'total_liters' del formato de mainorig.py)
+            import ujson
+            try:
+                with open(LEGACY_LOG_FILE, 'r') as f: d = ujson.load(f)
+                value = float(d.get('total', d.get('total_liters', 0.0)))
+            # AttributeError/TypeError: JSON valido pero sin la forma esperada
+            except (OSError, ValueError, AttributeError, TypeError): return liters
+            if value == value and value >= 0:
+                liters = value
+                # Sembrar el primer slot: en el proximo arranque ya no se lee el JSON
+                try:
+                    with open(LOG_SLOT_FILE.format(1), 'wb') as f: f.write(struct.pack('<Id', 1, liters))
+                    self._seq = 1
+                except OSError: pass
+        return liters
 
-    def save_liters(self):
+    def save_liters(self, force=False):
+        # Solo escribir en flash si el total cambio al menos SAVE_DELTA_L litros
+        if not force and (not self._dirty or abs(self.liters_total - self._last_saved) < SAVE_DELTA_L): return
+        # Rotar entre LOG_SLOTS archivos para repartir el desgaste de la flash
+        seq = self._seq + 1
         try:
-            with open(LOG_FILE, 'w') as f: ujson.dump({'total': self.liters_total}, f)
-        except: pass
+            with open(LOG_SLOT_FILE.format(seq % LOG_SLOTS), 'wb') as f: f.write(struct.pack('<Id', seq, self.liters_total))
+            self._seq = seq
+            self._last_saved = self.liters_total
+            self._dirty = False
+        except OSError: pass
 
     def get_formatted_time(self):
-        """Devuelve la fecha y hora actual formateada."""
-        t = time.localtime(time.time() + TIMEZONE_OFFSET_HOURS * 3600)
-        return "{:02d}/{:02d}/{:d} {:02d}:{:02d}:{:02d}".format(t[2], t[1], t[0], t[3], t[4], t[5])
+        """Devuelve la fecha y hora actual formateada (cacheada por segundo)."""
+        now = time.time()
+        if now == self._fmt_cache[0]: return self._fmt_cache[1]
+        # Reusar el localtime del tick actual si es del mismo segundo
+        t = self._tick_local if now == self._tick_now else time.localtime(now + _TZ_OFFSET_S)
+        text = "{:02d}/{:02d}/{:d} {:02d}:{:02d}:{:02d}".format(t[2], t[1], t[0], t[3], t[4], t[5])
+        self._fmt_cache = (now, text)
+        return text
 
     async def sync_time(self):
+        # ntptime solo se usa aqui; se importa al necesitarlo para no ocupar heap al inicio
+        gc.collect()
+        import ntptime
+        # settime() es bloqueante: acotar cada intento para que un servidor caido no congele el loop
+        ntptime.timeout = NTP_TIMEOUT_S
         for server in NTP_SERVERS:
             try:
                 ntptime.host = server
@@ -77,165 +224,217 @@ class SystemController:
                 self.time_synced = True
                 print(f"✅ Sincronizado: {self.get_formatted_time()}")
                 return True
-            except: continue
+            except OSError: pass
+            # Ceder el loop entre servidores
+            await asyncio.sleep(0)
         return False
 
-    def get_tank_level(self):
-        self.trig.value(0)
-        time.sleep_us(5)
-        self.trig.value(1)
-        time.sleep_us(10)
-        self.trig.value(0)
+    def _echo_handler(self, pin):
+        # Flanco de subida: inicio del eco; flanco de bajada: fin del eco
+        # Corre en IRQ dura: sin asignar memoria (ticks_us cabe en small int)
+        if pin.value():
+            self._t_rise = time.ticks_us()
+        else:
+            self._t_fall = time.ticks_us()
+            self._echo_flag.set()
+
+    async def _ping(self):
+        """Un disparo del HC-SR04; devuelve el nivel en % o None si no hubo eco valido."""
+        self._echo_flag.clear()
+        # Metodos en locales: pulso de disparo de 10 us mas parejo
+        tv = self.trig.value
+        sleep_us = time.sleep_us
+        tv(0)
+        sleep_us(5)
+        tv(1)
+        sleep_us(10)
+        tv(0)
         try:
-            duration = time_pulse_us(self.echo, 1, 30000)
-            if duration < 0: return 0
-            dist = (duration / 2) / 29.1
+            # Esperar el eco sin bloquear el loop (maximo 30 ms)
+            await asyncio.wait_for(self._echo_flag.wait(), 0.03)
+            duration = time.ticks_diff(self._t_fall, self._t_rise)
+            if duration < 0 or duration > PING_MAX_US: return None
+            dist = duration * _CM_PER_US
             return max(0, min(100, ((TANK_HEIGHT_CM - dist) / TANK_HEIGHT_CM) * 100))
-        except: return 0
+        except asyncio.TimeoutError: return None
+
+    async def get_tank_level(self):
+        # Lectura reciente: devolver el valor en cache
+        if time.ticks_diff(time.ticks_ms(), self._last_ping_ms) < PING_GUARD_MS: return self.water_level_pct
+        # Hasta PING_RETRIES disparos; la mediana descarta ecos sueltos raros
+        samples = []
+        for _ in range(PING_RETRIES):
+            level = await self._ping()
+            if level is not None: samples.append(level)
+            await asyncio.sleep_ms(PING_GUARD_MS)
+        self._last_ping_ms = time.ticks_ms()
+        # Si ningun intento fue valido se mantiene la ultima lectura buena
+        if not samples: return self.water_level_pct
+        samples.sort()
+        return samples[len(samples) // 2]
+
+    def _set(self, target, on):
+        """Escribe el pin del actuador (activo en bajo) y su estado en un solo lugar."""
+        pin = self.valve if target == 'valve' else self.motor
+        pin.value(0 if on else 1)
+        setattr(self, target + '_on', on)
 
     async def control_logic(self, target, action):
         """Lógica de control con protección de motor-válvula."""
-        if target == 'valve' and action is True:
+        if not action:
+            self._set(target, False)
+
+        elif target == 'valve':
             # 1. SI EL MOTOR ESTÁ ENCENDIDO, APAGAR Y ESPERAR
             if self.motor_on:
                 print("⚠️ Apagando motor antes de llenar...")
-                self.motor.value(1)
-                self.motor_on = False
+                self._set('motor', False)
                 await asyncio.sleep(2) # Pausa de seguridad
             
-            self.valve.value(0)
-            self.valve_on = True
-            self.valve_open_time = time.time()
+            self._set('valve', True)
+            self.valve_open_time = time.ticks_ms()
             self.alert_msg = ""
             
-        elif target == 'motor' and action is True:
-            if self.water_level_pct > 10:
-                if self.valve_on:
-                    self.valve.value(1)
-                    self.valve_on = False
-                self.motor.value(0)
-                self.motor_on = True
-            else:
-                self.alert_msg = "ERROR: Nivel bajo para motor."
-                
-        elif action is False:
-            if target == 'valve': 
-                self.valve.value(1)
-                self.valve_on = False
-            else: 
-                self.motor.value(1)
-                self.motor_on = False
+        elif self.water_level_pct > 10:
+            if self.valve_on: self._set('valve', False)
+            self._set('motor', True)
+        else:
+            self.alert_msg = "ERROR: Nivel bajo para motor."
             
-    async def check_system(self):
+    async def check_system(self, now, now_ms):
         if not self.time_synced: return
         
-        t = time.localtime(time.time() + TIMEZONE_OFFSET_HOURS * 3600)
-        h, m, s, wd = t[3], t[4], t[5], t[6]
-        
-        # Rutina Horaria
-        is_weekend = wd >= 5
-        start_h = 8 if is_weekend else 7
-        if m == 0 and s == 0 and h in [start_h, 12, 19]:
-            if not self.valve_on:
-                print("⏰ Horario programado detectado.")
-                await self.control_logic('valve', True)
+        # Rutina Horaria: solo una vez por minuto, sin localtime en los demas ticks
+        minute = (now + _TZ_OFFSET_S) // 60
+        if minute != self._last_checked_minute:
+            self._last_checked_minute = minute
+            # Compartido con get_formatted_time si se pide en el mismo segundo
+            t = time.localtime(now + _TZ_OFFSET_S)
+            self._tick_now, self._tick_local = now, t
+            h, m, wd = t[3], t[4], t[6]
+            hours = _HOURS_WEEKEND if wd >= 5 else _HOURS_WEEK
+            if m == 0 and h in hours:
+                if not self.valve_on:
+                    print("⏰ Horario programado detectado.")
+                    await self.control_logic('valve', True)
 
         # Monitoreo de flujo
         if self.valve_on:
-            tiempo_abierta = time.time() - self.valve_open_time
-            if tiempo_abierta > FLOW_TIMEOUT:
+            # Reloj monotono: no salta cuando NTP ajusta la hora
+            tiempo_abierta = time.ticks_diff(now_ms, self.valve_open_time)
+            if tiempo_abierta > FLOW_TIMEOUT * 1000:
                 if self.pulses == 0:
                     await self.control_logic('valve', False)
                     # 2. INCLUIR FECHA Y HORA EN EL MENSAJE
                     self.alert_msg = f"✅ Llenado finalizado: {self.get_formatted_time()}"
                     print(self.alert_msg)
 
+    # --- Acciones POST del formulario web ---
+    async def _valve_toggle(self): await self.control_logic('valve', not self.valve_on)
+
+    async def _motor_toggle(self): await self.control_logic('motor', not self.motor_on)
+
+    async def _flow_reset(self):
+        self.liters_total = 0.0
+        self.save_liters(force=True)
+
+    _POST_ROUTES = {b"/valve/toggle": _valve_toggle, b"/motor/toggle": _motor_toggle, b"/flow/reset": _flow_reset}
+
     async def serve_client(self, reader, writer):
         try:
-            line = await reader.readline()
-            req = str(line)
-            method = req.split(' ')[0].replace("b'", "")
-            path = req.split(' ')[1]
-            while await reader.readline() != b"\r\n": pass
-
-            if method == "POST":
-                if "/valve/toggle" in path: await self.control_logic('valve', not self.valve_on)
-                elif "/motor/toggle" in path: await self.control_logic('motor', not self.motor_on)
-                elif "/flow/reset" in path:
-                    self.liters_total = 0.0
-                    self.save_liters()
-                writer.write(b"HTTP/1.1 303 See Other\r\nLocation: /\r\n\r\n")
+            try:
+                # Sin Nagle: las respuestas cortas salen en cuanto se escriben
+                writer.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except (AttributeError, OSError): pass # puerto sin TCP_NODELAY
+            # Leer linea de peticion + cabeceras en bloque (normalmente una sola lectura)
+            req = b""
+            while b"\r\n\r\n" not in req and len(req) < MAX_REQUEST_BYTES:
+                chunk = await reader.read(512)
+                if not chunk: break
+                req += chunk
+            parts = req.split(b"\r\n", 1)[0].split(b' ', 2)
+            method = parts[0]
+            path = parts[1]
+
+            if method == b"POST":
+                # Ruta exacta (sin query string) -> manejador
+                handler = self._POST_ROUTES.get(path.split(b'?', 1)[0])
+                if handler: await handler(self)
+                # Despertar el loop de nivel para que el cambio se refleje ya
+                self._wake.set()
+                writer.write(HTTP_REDIRECT)
             else:
                 # 3. MOSTRAR HORA ACTUAL EN LA WEB
                 current_time_str = self.get_formatted_time()
-                alert_html = f"<div style='color:#155724; background:#d4edda; padding:10px; border-radius:5px; margin-bottom:10px;'>{self.alert_msg}</div>" if self.alert_msg else ""
-                
-                response = f"""HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n
-                <html><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1">
-                <style>
-                    body {{ font-family: sans-serif; text-align: center; background: #f0f2f5; }}
-                    .card {{ background: white; margin: 10px auto; padding: 20px; border-radius: 12px; max-width: 350px; box-shadow: 0 4px 10px rgba(0,0,0,0.1); }}
-                    .btn {{ display: block; width: 100%; padding: 15px; margin: 8px 0; border: none; border-radius: 8px; color: white; font-weight: bold; cursor: pointer; }}
-                    .on {{ background: #28a745; }} .off {{ background: #dc3545; }} .reset {{ background: #6c757d; font-size: 0.8em; }}
-                    .bar {{ background: #eee; border-radius: 10px; height: 20px; }}
-                    .fill {{ background: #007bff; height: 100%; width: {self.water_level_pct}%; border-radius: 10px; transition: 1s; }}
-                    .clock {{ font-size: 1.2em; color: #333; font-weight: bold; margin-bottom: 15px; }}
-                </style></head><body>
-                    <div class="card">
-                        <div class="clock">🕒 {current_time_str}</div>
-                        <h2>Control de Agua</h2>
-                        {alert_html}
-                        <p>Tanque: {self.water_level_pct:.1f}%</p>
-                        <div class="bar"><div class="fill"></div></div>
-                        <p>Total: {self.liters_total:.2f} L</p>
-                        <form action="/flow/reset" method="POST"><button type="submit" class="btn reset">RESETEAR CONTADOR</button></form>
-                    </div>
-                    <div class="card">
-                        <form action="/valve/toggle" method="POST"><button class="btn {"off" if self.valve_on else "on"}">{"CERRAR VÁLVULA" if self.valve_on else "ABRIR VÁLVULA"}</button></form>
-                        <form action="/motor/toggle" method="POST"><button class="btn {"off" if self.motor_on else "on"}">{"APAGAR MOTOR" if self.motor_on else "ENCENDER MOTOR"}</button></form>
-                    </div>
-                    <p style='font-size:0.7em;'>Estado: {"Sincronizado" if self.time_synced else "Sin hora"}</p>
-                    <script>setTimeout(()=>{{ if(!document.hidden) location.reload(); }}, 5000);</script>
-                </body></html>
-                """
-                writer.write(response.encode('utf-8'))
+                alert_html = HTML_ALERT % self.alert_msg if self.alert_msg else ""
+                body = HTML_BODY % (
+                    current_time_str, alert_html, self.water_level_pct, self.water_level_pct, self.liters_total,
+                    "off" if self.valve_on else "on", "CERRAR VÁLVULA" if self.valve_on else "ABRIR VÁLVULA",
+                    "off" if self.motor_on else "on", "APAGAR MOTOR" if self.motor_on else "ENCENDER MOTOR",
+                    "Sincronizado" if self.time_synced else "Sin hora")
+                # Enviar por partes para no tener toda la respuesta en RAM a la vez
+                writer.write(HTML_HEAD)
+                await writer.drain()
+                writer.write(body.encode('utf-8'))
+                await writer.drain()
+                writer.write(HTML_TAIL)
             await writer.drain()
-            await writer.wait_closed()
-        except Exception as e:
+        except (OSError, IndexError) as e:
             print("Error en servidor:", e)
+        finally:
+            # Cerrar siempre el socket para liberar los PCB de LWIP cuanto antes
+            writer.close()
+            await writer.wait_closed()
+            gc.collect()
 
-    async def background_tasks(self):
-        save_tick = 0
-        sync_tick = 0
+    async def _level_task(self):
+        """Lee el nivel, acumula pulsos y revisa la rutina cada segundo."""
         while True:
-            self.water_level_pct = self.get_tank_level()
+            # Llenando el nivel cambia lento; con motor se necesita para el corte del 10%
+            self._ping_tick += 1
+            if self._ping_tick >= (PING_EVERY_MOTOR if self.motor_on else PING_EVERY_VALVE if self.valve_on else PING_EVERY_IDLE):
+                self._ping_tick = 0
+                self.water_level_pct = await self.get_tank_level()
+            self.pulses = self._read_pulses()
             if self.pulses > 0:
-                self.liters_total += self.pulses / self.config['K_FACTOR']
-                self.pulses = 0
-            
-            await self.check_system()
+                self.liters_total += self.pulses * self.k_factor_inv
+                self._dirty = True
             
-            sync_tick += 1
-            if sync_tick >= 3600:
-                await self.sync_time()
-                sync_tick = 0
+            # Relojes leidos una sola vez por tick
+            await self.check_system(time.time(), time.ticks_ms())
+            # Esperar 1 s o hasta que una accion web despierte el loop
+            try:
+                await asyncio.wait_for(self._wake.wait(), 1)
+                self._wake.clear()
+            except asyncio.TimeoutError: pass
 
-            save_tick += 1
-            if save_tick >= 30:
-                self.save_liters()
-                save_tick = 0
-            await asyncio.sleep(1)
+    async def _save_task(self):
+        """Guarda el contador de litros cada 30 segundos."""
+        while True:
+            await asyncio.sleep(30)
+            self.save_liters()
+
+    async def _sync_task(self):
+        """Resincroniza la hora con NTP cada hora."""
+        while True:
+            await asyncio.sleep(3600)
+            await self.sync_time()
 
     async def run(self):
         # Descomenta las líneas de abajo si necesitas configurar el Wi-Fi aquí
+        # import network
         # wlan = network.WLAN(network.STA_IF)
         # wlan.active(True)
         # wlan.connect(self.config['WIFI_SSID'], self.config['WIFI_PASS'])
         # while not wlan.isconnected(): await asyncio.sleep(1)
         
         await self.sync_time()
-        asyncio.create_task(self.background_tasks())
-        await asyncio.start_server(self.serve_client, "0.0.0.0", 80)
+        asyncio.create_task(self._level_task())
+        asyncio.create_task(self._save_task())
+        asyncio.create_task(self._sync_task())
+        # GC automatico al consumir 1/4 de la memoria libre, para no fragmentar el heap
+        gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
+        await asyncio.start_server(self.serve_client, "0.0.0.0", 80, backlog=2)
         while True: await asyncio.sleep(10)
 
 if __name__ == "__main__":
@@ -1,18 +1,30 @@
-from machine import Pin, UART, SoftI2C, freq, Timer, reset
+from machine import Pin, UART, SoftI2C, freq, Timer, reset, disable_irq, enable_irq
 import network
 import ntptime
 import time
 import bluetooth
+import esp32
+import struct
 import gc
+import os
 import _thread
 import ujson
+from collections import deque
+from array import array
+import micropython
+try:
+    from machine import Counter # PCNT por hardware (firmware >= 1.25)
+except ImportError:
+    Counter = None
 from micropython import const # Necesario si defines tus propias constantes, aunque usaremos las de bluetooth
 
 # ----------------------------------------------------------------------
 # --- CONSTANTES DE SISTEMA Y CONFIGURACIÓN ---
 # ----------------------------------------------------------------------
-CONFIG_FILE = 'config.json'
-LOG_FILE = 'water_log.json'
+STATE_FILE = 'state.json' # {"config": {...}}; el total de litros se guarda en NVS
+# Archivos separados de versiones anteriores (solo se leen para migrar a STATE_FILE)
+LEGACY_CONFIG_FILE = 'config.json'
+LEGACY_LOG_FILE = 'water_log.json'
 
 DEFAULT_CONFIG = {
     'WIFI_SSID': 'WOWIFI',
@@ -24,20 +36,45 @@ DEFAULT_CONFIG = {
     'NTP_HOST': '3.south-america.pool.ntp.org'
 }
 
+# Trazas del camino caliente (por tick / por comando). 0 = desactivadas, el compilador las elimina
+DEBUG = const(0)
+
 # Pines (Asegúrate que estos pines son válidos para tu ESP32)
-VALVE_PIN = 23
-MOTOR_PIN = 22
-FLOW_SENSOR_PIN = 18
+VALVE_PIN = const(23)
+MOTOR_PIN = const(22)
+FLOW_SENSOR_PIN = const(18)
+
+# Intervalos del bucle principal
+_TICK_MS = const(1000)
+_TICK_LATE_MS = const(10) # reintento si el Timer se atrasa respecto del tick previsto
+_LOG_SAVE_INTERVAL = const(60) # s entre guardados del total en NVS
+_NOTIFY_INTERVAL = const(5) # s entre notificaciones de estado
+_SEC_PER_HOUR = const(3600)
 
 # ----------------------------------------------------------------------
 # --- CONSTANTES BLE (MicroPython) ---
 # ----------------------------------------------------------------------
 
 BLE_DEVICE_NAME = "ESP32WC"
-_IRQ_CENTRAL_CONNECT = 1
-_IRQ_CENTRAL_DISCONNECT = 2
-_IRQ_GATTS_WRITE = 3 # Evento de escritura a una característica (incluye CCCD)
-_ADV_INTERVAL_MS = 500
+_IRQ_CENTRAL_CONNECT = const(1)
+_IRQ_CENTRAL_DISCONNECT = const(2)
+_IRQ_GATTS_WRITE = const(3) # Evento de escritura a una característica (incluye CCCD)
+_IRQ_MTU_EXCHANGED = const(21)
+_BLE_MTU = const(247) # ATT MTU pedido: el estado completo (~80 bytes) entra en una sola notificación
+_CONTROL_BUF_LEN = const(128) # Bytes máximos de un comando escrito (por defecto la pila guarda solo 20)
+_ADV_INTERVAL_US = const(50000) # gap_advertise recibe microsegundos: 50 ms
+
+# Opcodes del protocolo binario de control: [opcode][payload]
+# VALVE/MOTOR: 1 byte (1=ON, 0=OFF). SCHED: pares (hora, minuto). STATUS/RESET: sin payload.
+_OP_VALVE = const(1)
+_OP_MOTOR = const(2)
+_OP_SCHED = const(3)
+_OP_STATUS = const(4)
+_OP_RESET = const(5)
+
+# Trabajos del hilo secundario (ver SystemController._worker)
+_JOB_SAVE = const(1)
+_JOB_NOTIFY = const(2)
 
 # UUIDs
 # 1. Servicio Principal (Battery Service: 0x180F - ELEGIDO COMO EJEMPLO)
@@ -67,59 +104,118 @@ _SERVICES = (
 # ----------------------------------------------------------------------
 
 class ConfigManager:
-    """Maneja la carga y guardado de la configuración (config.json) y el log de agua (water_log.json)."""
+    """Maneja la configuración (state.json) y el total de agua (NVS, espacio de nombres 'wc')."""
 
     def __init__(self):
         self.config = DEFAULT_CONFIG.copy()
         self.flow_liters_total = 0.0
+        self._last_saved_liters = None
+        self._state = None
+        self._last_state_json = None
+        # El total de litros vive en NVS: 8 bytes sin pasar por el sistema de archivos ni JSON
+        self._nvs = esp32.NVS('wc')
+        # Buffer fijo para el blob del total: pack_into sin crear bytes en cada guardado
+        self._log_buf = bytearray(8)
+        # Primer uso de ujson en frío: acelera los load/dump posteriores de la sesión
+        ujson.dumps(None)
+
+    def _read_state(self):
+        """Lee state.json una sola vez; si no existe, migra config.json y water_log.json."""
+        if self._state is None:
+            try:
+                with open(STATE_FILE, 'r') as f:
+                    self._state = ujson.load(f)
+            except (OSError, ValueError):
+                self._state = {'migrated': True}
+                for key, path in (('config', LEGACY_CONFIG_FILE), ('log', LEGACY_LOG_FILE)):
+                    try:
+                        with open(path, 'r') as f:
+                            self._state[key] = ujson.load(f)
+                    except (OSError, ValueError):
+                        pass
+        return self._state
 
-    def load_config(self):
-        """Carga la configuración desde config.json o usa valores por defecto."""
+    def _save_state(self):
+        """Escribe la configuración en state.json (archivo temporal + rename)."""
+        # Serializar una vez y escribir en un solo write; igual que lo guardado: no tocar la flash
+        buf = ujson.dumps({'config': self.config})
+        if buf == self._last_state_json:
+            return
+        tmp = STATE_FILE + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(buf)
         try:
-            with open(CONFIG_FILE, 'r') as f:
-                loaded_config = ujson.load(f)
-                # Solo actualizar las claves que existen para mantener DEFAULT_CONFIG si se añaden nuevas
-                for key in DEFAULT_CONFIG:
-                    if key in loaded_config:
-                        self.config[key] = loaded_config[key]
+            os.rename(tmp, STATE_FILE) # LittleFS reemplaza el destino de forma atómica
+        except OSError:
+            # FAT no sobrescribe al renombrar
+            os.remove(STATE_FILE)
+            os.rename(tmp, STATE_FILE)
+        self._last_state_json = buf
+
+    def load_config(self):
+        """Carga la configuración desde state.json o usa valores por defecto."""
+        loaded_config = self._read_state().get('config')
+        if loaded_config:
+            # Solo actualizar las claves que existen para mantener DEFAULT_CONFIG si se añaden nuevas
+            for key in DEFAULT_CONFIG:
+                if key in loaded_config:
+                    self.config[key] = loaded_config[key]
             print("✅ Configuración cargada de archivo.")
-        except (OSError, ValueError):
-            print("⚠️ No se encontró o falló la lectura de config.json. Usando y guardando valores por defecto.")
+            if self._state.get('migrated'):
+                # Primer arranque tras la migración: crear state.json
+                self._save_state()
+        else:
+            print("⚠️ No se encontró o falló la lectura de la configuración. Usando y guardando valores por defecto.")
             self.save_config(DEFAULT_CONFIG.copy())
 
     def save_config(self, new_config):
-        """Guarda el diccionario de configuración en config.json."""
+        """Guarda el diccionario de configuración en state.json."""
         try:
             self.config.update(new_config)
-            with open(CONFIG_FILE, 'w') as f:
-                ujson.dump(self.config, f)
+            self._save_state()
             print("✅ Configuración guardada.")
             return True
         except Exception as e:
-            print(f"❌ Error al guardar config.json: {e}")
+            print(f"❌ Error al guardar state.json: {e}")
             return False
 
     def load_log(self):
-        """Carga el volumen total de agua desde water_log.json."""
+        """Carga el volumen total de agua desde NVS (o lo migra desde el log en archivo)."""
         try:
-            with open(LOG_FILE, 'r') as f:
-                log_data = ujson.load(f)
-                self.flow_liters_total = log_data.get('total_liters', 0.0)
+            self._nvs.get_blob('total', self._log_buf)
+            self.flow_liters_total = struct.unpack('<d', self._log_buf)[0]
+            self._last_saved_liters = self.flow_liters_total
             print(f"✅ Log de agua cargado. Total acumulado: {self.flow_liters_total:.2f} L")
-        except (OSError, ValueError):
-            print("⚠️ No se encontró o falló la lectura de water_log.json. Iniciando contador en 0.0 L")
-            self.save_log(0.0)
+        except OSError:
+            log_data = self._read_state().get('log')
+            if log_data:
+                total = log_data.get('total_liters', 0.0)
+                print(f"✅ Log de agua migrado a NVS. Total acumulado: {total:.2f} L")
+            else:
+                total = 0.0
+                print("⚠️ No se encontró el log de agua en NVS. Iniciando contador en 0.0 L")
+            self.save_log(total)
+        # Ya no hace falta el contenido leído
+        self._state = None
 
     def save_log(self, total_liters):
-        """Guarda el volumen total de agua en water_log.json."""
+        """Guarda el volumen total de agua en NVS."""
         self.flow_liters_total = total_liters
+        return self.write_log(total_liters)
+
+    def write_log(self, total_liters):
+        """Escribe el total en NVS sin tocar el contador en memoria (hilo de trabajo)."""
+        # Sin cambios desde la última escritura: no tocar la flash
+        if self._last_saved_liters == total_liters:
+            return True
         try:
-            log_data = {'total_liters': self.flow_liters_total, 'timestamp': time.time()}
-            with open(LOG_FILE, 'w') as f:
-                ujson.dump(log_data, f)
+            struct.pack_into('<d', self._log_buf, 0, total_liters)
+            self._nvs.set_blob('total', self._log_buf)
+            self._nvs.commit()
+            self._last_saved_liters = total_liters
             return True
         except Exception as e:
-            print(f"❌ Error al guardar water_log.json: {e}")
+            print(f"❌ Error al guardar el log en NVS: {e}")
             return False
 
 # ----------------------------------------------------------------------
@@ -129,43 +225,61 @@ class ConfigManager:
 class FlowSensor:
     """Maneja el pin del sensor de flujo y la lógica de interrupción."""
 
-    def __init__(self, pin_number, k_factor, lock):
-        self.k_factor = k_factor
-        self.lock = lock
-        self.pulses_total = 0 
+    def __init__(self, pin_number, k_factor):
+        self.set_k_factor(k_factor)
+        # Contador en un array: el ISR lo incrementa sin asignar memoria ni usar locks
+        self._pulses = array('i', [0])
         # Configurar Pin con resistencia pull-down interna
         self.pin = Pin(pin_number, Pin.IN, Pin.PULL_DOWN)
         
-        # Configurar la interrupción (IRQ)
-        self.pin.irq(trigger=Pin.IRQ_RISING, handler=self._irq_handler)
+        if Counter:
+            # PCNT por hardware: cuenta los flancos sin entrar a Python, con filtro anti-rebote de 1 us
+            self.counter = Counter(0, self.pin, edge=Counter.RISING, filter_ns=1000)
+        else:
+            # Sin PCNT: configurar la interrupción (IRQ)
+            self.counter = None
+            self.pin.irq(trigger=Pin.IRQ_RISING, handler=self._irq_handler)
         print(f"✅ Sensor de flujo en Pin {pin_number} inicializado.")
 
+    @micropython.native
     def _irq_handler(self, pin):
         """Rutina de Servicio de Interrupción (ISR). DEBE ser lo más simple posible."""
-        # Proteger la variable compartida con el lock (necesario en micropython multithreading)
-        # Nota: En un simple bucle principal sin hilo secundario, el lock puede no ser estrictamente
-        # necesario para el ISR, pero es una buena práctica de seguridad.
-        if self.lock.acquire(0): # Intenta adquirir el bloqueo sin esperar
-            self.pulses_total += 1
-            self.lock.release()
+        # Sin lock: con acquire(0) se perdían pulsos cuando el bucle principal tenía el bloqueo.
+        # El ISR no se interrumpe a sí mismo y la lectura se protege deshabilitando IRQs.
+        self._pulses[0] += 1
 
     def read_and_reset_pulses(self):
         """Lee el número de pulsos acumulados desde la última lectura y los reinicia."""
-        with self.lock:
-            current_pulses = self.pulses_total
-            self.pulses_total = 0
+        if self.counter:
+            # Lectura y reinicio atómicos en el PCNT (Counter extiende el registro de 16 bits)
+            return self.counter.value(0)
+        return self._read_and_reset_isr()
+
+    @micropython.viper
+    def _read_and_reset_isr(self) -> int:
+        """Lee y reinicia el contador del ISR con las interrupciones deshabilitadas."""
+        p = ptr32(self._pulses)
+        state = disable_irq()
+        current_pulses = p[0]
+        p[0] = 0
+        enable_irq(state)
         return current_pulses
 
+    def set_k_factor(self, k_factor):
+        """Fija el factor K (pulsos/litro) y precalcula sus recíprocos."""
+        self.k_factor = k_factor
+        # Multiplicar en cada tick en lugar de dividir (FP por software en el ESP32)
+        self._inv_k = 1.0 / k_factor
+        self._lpm_scale = 60.0 / k_factor
+
+    @micropython.native
     def calculate_flow(self, pulses, seconds_passed=1):
         """Calcula el flujo instantáneo (L/min) y el volumen añadido (L)."""
-        liters_added = pulses / self.k_factor
-
-        if seconds_passed > 0 and pulses > 0:
-            # (Pulsos/segundo) * (60 segundos/minuto) / (Pulsos/Litro)
-            flow_rate_lpm = (pulses / seconds_passed) * (60.0 / self.k_factor)
-        else:
-            flow_rate_lpm = 0.0
-
+        liters_added = pulses * self._inv_k
+        # (Pulsos/segundo) * (60 segundos/minuto) / (Pulsos/Litro); 0 pulsos da 0.0
+        flow_rate_lpm = pulses * self._lpm_scale
+        if seconds_passed != 1:
+            flow_rate_lpm = flow_rate_lpm / seconds_passed if seconds_passed > 0 else 0.0
         return flow_rate_lpm, liters_added
 
 # ----------------------------------------------------------------------
@@ -191,6 +305,8 @@ class BLEController:
         """Configura e inicia el servicio BLE."""
         global _SERVICES 
         self.ble.active(True)
+        # Con el MTU por defecto (23) cada notificación se corta a 20 bytes
+        self.ble.config(mtu=_BLE_MTU)
         self.ble.irq(self._ble_irq)
         
         # Intenta registrar los servicios
@@ -210,8 +326,15 @@ class BLEController:
         # handles[0][1] es la tupla (handle_valor, handle_cccd) para la segunda característica.
         self.status_handle = handles[0][1] 
         
+        # Buffer de la característica de control: "SCHEDULE SET ..." supera los 20 bytes por defecto
+        self.ble.gatts_set_buffer(self.control_handle, _CONTROL_BUF_LEN)
         print(f"BLE Handles: Control={self.control_handle}, Status={self.status_handle}")
 
+        # Crear Advertising Data una sola vez: Flags (0x06) + Nombre del dispositivo (0x09)
+        name_bytes = self.device_name.encode('utf-8')
+        # Tipo 0x09: Complete Local Name. El primer byte es la longitud total (longitud_nombre + 1 para el tipo)
+        self._adv_data = b'\x02\x01\x06' + bytes([len(name_bytes) + 1, 0x09]) + name_bytes
+
         self.advertise()
         print("✅ Servicio BLE inicializado y publicitando.")
 
@@ -244,16 +367,12 @@ class BLEController:
             # La escritura en el CCCD (para habilitar notificaciones) es gestionada 
             # internamente por la pila BLE de MicroPython/NimBLE.
 
+        elif event == _IRQ_MTU_EXCHANGED:
+            if DEBUG: print("BLE: MTU negociado", data[1])
+
     def advertise(self):
         """Inicia la publicidad BLE."""
-        # Crear Advertising Data: Flags (0x06) + Nombre del dispositivo (0x09)
-        adv_flags = b'\x02\x01\x06' 
-        name_bytes = self.device_name.encode('utf-8')
-        # Tipo 0x09: Complete Local Name. El primer byte es la longitud total (longitud_nombre + 1 para el tipo)
-        adv_name = bytes([len(name_bytes) + 1, 0x09]) + name_bytes
-        adv_data = adv_flags + adv_name
-
-        self.ble.gap_advertise(_ADV_INTERVAL_MS, adv_data=adv_data)
+        self.ble.gap_advertise(_ADV_INTERVAL_US, adv_data=self._adv_data)
     """
     def notify_status(self, status_msg):
         # Notifica el estado actual al cliente BLE a través del handle de status.
@@ -270,10 +389,15 @@ class BLEController:
     # Modificación en la clase BLEController
     def notify_status(self, status_msg):
         """Notifica el estado actual al cliente BLE a través del handle de status."""
+        return self.notify_status_bytes(status_msg.encode('utf8'))
+
+    def notify_status_bytes(self, payload):
+        """Notifica un mensaje de estado ya codificado (bytes), sin volver a codificarlo."""
         if self.conn_handle and self.status_handle:
             try:
+                # Los bytes ya formateados van directo: gatts_notify los copia a su propio buffer
                 # Usar gatts_notify requiere que el cliente haya escrito 0x0001 en el CCCD.
-                self.ble.gatts_notify(self.conn_handle, self.status_handle, status_msg.encode('utf8'))
+                self.ble.gatts_notify(self.conn_handle, self.status_handle, payload)
                 # print("DEBUG: Status notified successfully.") # Opcional: para confirmación
                 return True
             except Exception as e:
@@ -293,18 +417,27 @@ class BLEController:
 class SystemController:
     """Clase principal que coordina todos los componentes y la lógica de control."""
 
+    # Formato del mensaje de estado BLE: se formatea directo a bytes, sin str intermedio ni encode
+    _STATUS_FMT = b"STATUS:TIME=%02d:%02d:%02d;VALVE=%d;MOTOR=%d;FLOW_TOTAL=%.2fL;SCHEDULE=%d"
+
     def __init__(self):
         # 0. Inicializar
-        self.lock = _thread.allocate_lock()
         self.config_manager = ConfigManager()
         self.config_manager.load_config()
         self.config_manager.load_log()
+        # GC por umbral de asignación: MicroPython recolecta solo cuando hace falta
+        gc.collect()
+        gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
 
         # Cargar configuración activa
         self.config = self.config_manager.config
         self.k_factor = self.config['K_FACTOR']
         self.timezone_offset_hours = self.config['TIMEZONE_OFFSET_HOURS']
+        # Entero: time.time() + offset queda en la ruta de enteros (admite zonas de media hora)
+        self._tz_seconds = int(self.timezone_offset_hours * _SEC_PER_HOUR)
         self.scheduled_times = self.config['SCHEDULED_TIMES']
+        # Horarios como minutos del día (h*60+m): la consulta por tick no crea tuplas
+        self._scheduled_set = frozenset(h * 60 + m for h, m in self.scheduled_times)
         self.flow_stop_timeout = self.config['FLOW_STOP_TIMEOUT']
 
         # 1. Inicializar Pines (Actuadores apagados por defecto)
@@ -312,20 +445,66 @@ class SystemController:
         self.motor_pin = Pin(MOTOR_PIN, Pin.OUT, value=0)
 
         # 2. Inicializar Sensores y Estados
-        self.flow_sensor = FlowSensor(FLOW_SENSOR_PIN, self.k_factor, self.lock)
+        self.flow_sensor = FlowSensor(FLOW_SENSOR_PIN, self.k_factor)
         self.valve_on = False
         self.motor_on = False
         self.scheduled_run_active = False
         self.flow_stop_timer_start = 0
+        self._last_status = None
+        # Prefijos de los comandos de texto (ver process_ble_command)
+        self._cmd_table = (
+            (b"VALVE ", self._cmd_valve),
+            (b"MOTOR ", self._cmd_motor),
+            (b"SCHEDULE SET ", self._cmd_sched),
+            (b"STATUS", self._cmd_status),
+            (b"RESET_FLOW", self._cmd_reset),
+        )
 
         # 3. Inicializar BLE
         self.ble_controller = BLEController(BLE_DEVICE_NAME, self.process_ble_command)
 
+        # Hilo de trabajo para la E/S lenta (flash y notificaciones BLE) fuera del bucle de control
+        self._jobs = deque((), 8)
+        # Semáforo binario: tomado = cola vacía; _enqueue lo libera para despertar al hilo
+        self._jobs_ready = _thread.allocate_lock()
+        self._jobs_ready.acquire()
+        _thread.start_new_thread(self._worker, ())
+
         # 4. Inicializar Wi-Fi y Tiempo
         self.wlan = network.WLAN(network.STA_IF)
         self._connect_wifi()
         self.sync_time()
 
+    def _worker(self):
+        """Hilo secundario: ejecuta las escrituras a flash y notificaciones BLE encoladas."""
+        cm = self.config_manager
+        ble = self.ble_controller
+        jobs = self._jobs
+        while True:
+            # Bloquea sin consumir CPU hasta que _enqueue avise
+            self._jobs_ready.acquire()
+            while jobs:
+                try:
+                    job, arg = jobs.popleft()
+                    if job == _JOB_SAVE:
+                        cm.write_log(arg)
+                    elif job == _JOB_NOTIFY:
+                        ble.notify_status_bytes(arg)
+                except Exception as e:
+                    print(f"❌ Error en hilo de trabajo: {e}")
+
+    def _enqueue(self, job):
+        """Encola un trabajo para el hilo secundario y lo despierta."""
+        self._jobs.append(job)
+        if self._jobs_ready.locked():
+            self._jobs_ready.release()
+
+    def _reset_flow(self):
+        """Reinicia el contador de litros y encola su guardado."""
+        self.config_manager.flow_liters_total = 0.0
+        self._enqueue((_JOB_SAVE, 0.0))
+        return "OK: FLOW_TOTAL reset to 0.0"
+
     # --- Métodos de Red y Tiempo ---
 
     def _connect_wifi(self):
@@ -357,8 +536,7 @@ class SystemController:
             ntptime.host = self.config['NTP_HOST']
             ntptime.settime()
 
-            local_seconds = time.time() + self.timezone_offset_hours * 3600
-            time.localtime(local_seconds)
+            local_seconds = time.time() + self._tz_seconds
             print(f"✅ Hora sincronizada y ajustada a UTC{self.timezone_offset_hours}.")
             print(f"✅ Hora actual: {time.localtime(local_seconds)}")
             return True
@@ -367,11 +545,9 @@ class SystemController:
             return False
 
     def get_current_time(self):
-        """Retorna la hora, minuto y segundo actuales locales (hh, mm, ss)."""
-        # Calcular el tiempo local aplicando el offset
-        local_seconds = time.time() + self.timezone_offset_hours * 3600
-        t = time.localtime(local_seconds)
-        return t[3], t[4], t[5] # Hora, minuto, segundo
+        """Retorna la tupla localtime local (hora en [3], minuto en [4], segundo en [5])."""
+        # Calcular el tiempo local aplicando el offset precalculado
+        return time.localtime(time.time() + self._tz_seconds)
 
     # --- Métodos de Actuadores ---
 
@@ -384,7 +560,7 @@ class SystemController:
         target_state = 1 if state else 0
         self.motor_pin.value(target_state)
         self.motor_on = (target_state == 1)
-        print(f"MOTOR {'ON' if self.motor_on else 'OFF'}")
+        if DEBUG: print(f"MOTOR {'ON' if self.motor_on else 'OFF'}")
 
     def set_valve(self, state):
         """Enciende (True) o apaga (False) la válvula. Apaga el motor si está encendido (seguridad)."""
@@ -396,7 +572,7 @@ class SystemController:
         target_state = 1 if state else 0
         self.valve_pin.value(target_state)
         self.valve_on = (target_state == 1)
-        print(f"VALVE {'ON' if self.valve_on else 'OFF'}")
+        if DEBUG: print(f"VALVE {'ON' if self.valve_on else 'OFF'}")
 
         # Si se apaga manualmente o por seguridad, se cancela la ejecución programada
         if not self.valve_on:
@@ -417,13 +593,19 @@ class SystemController:
                 if 0 <= h <= 23 and 0 <= m <= 59:
                     new_times.append([h, m])
                 else:
-                    return f"ERR: Hora inválida {part}"
+                    if DEBUG: print("Hora inválida:", part)
+                    return "ERR: Hora inválida"
 
         except Exception:
             return "ERR: Formato de horario incorrecto (HH:MM,HH:MM)"
 
+        return self._save_schedule(new_times)
+
+    def _save_schedule(self, new_times):
+        """Aplica y guarda una lista de horarios [[h, m], ...] ya validada."""
         if new_times:
             self.scheduled_times = new_times
+            self._scheduled_set = frozenset(h * 60 + m for h, m in new_times)
             if self.config_manager.save_config({'SCHEDULED_TIMES': new_times}):
                 print(f"✅ Nuevo horario guardado: {self.scheduled_times}")
                 return "OK: Horario actualizado"
@@ -431,142 +613,218 @@ class SystemController:
                 return "ERR: Fallo al guardar config"
         return "ERR: Horario no procesado"
 
+    def _process_binary_command(self, command_bytes):
+        """Procesa un comando binario: 1 byte de opcode + payload (ver _OP_*)."""
+        op = command_bytes[0]
+        if op == _OP_VALVE and len(command_bytes) == 2:
+            self.set_valve(command_bytes[1] == 1)
+        elif op == _OP_MOTOR and len(command_bytes) == 2:
+            self.set_motor(command_bytes[1] == 1)
+        elif op == _OP_SCHED:
+            # Payload: pares de bytes (hora, minuto)
+            payload = command_bytes[1:]
+            if not payload or len(payload) % 2:
+                return "ERR: Formato de horario incorrecto"
+            new_times = []
+            for i in range(0, len(payload), 2):
+                h, m = payload[i], payload[i + 1]
+                if h > 23 or m > 59:
+                    return "ERR: Hora inválida"
+                new_times.append([h, m])
+            return self._save_schedule(new_times)
+        elif op == _OP_STATUS:
+            # Notificar el estado y no enviar respuesta de control.
+            self.notify_status(force=True)
+            return None
+        elif op == _OP_RESET:
+            return self._reset_flow()
+        else:
+            return "ERR: Comando desconocido"
+        return "OK"
+
+    # --- Comandos de texto: cada manejador recibe el resto del comando (bytes) ---
+
+    def _cmd_valve(self, arg):
+        if b' ' in arg: return "ERR: Comando desconocido"
+        self.set_valve(arg == b"ON")
+        return "OK"
+
+    def _cmd_motor(self, arg):
+        if b' ' in arg: return "ERR: Comando desconocido"
+        self.set_motor(arg == b"ON")
+        return "OK"
+
+    def _cmd_sched(self, arg):
+        return self._process_schedule_command(arg.decode())
+
+    def _cmd_status(self, arg):
+        if arg: return "ERR: Comando desconocido"
+        # Notificar el estado y no enviar respuesta de control.
+        self.notify_status(force=True)
+        return None
+
+    def _cmd_reset(self, arg):
+        # Token exacto: un typo como RESET_FLOWER no debe borrar el contador
+        if arg: return "ERR: Comando desconocido"
+        return self._reset_flow()
 
     def process_ble_command(self, command_bytes):
         """Procesa comandos recibidos por BLE (callback del BLEController)."""
         try:
-            command = command_bytes.decode().strip().upper()
-            print(f"BLE CMD: {command}")
-            parts = command.split(' ', 2)
-            response = "OK"
+            # Solo un opcode valido indica protocolo binario; el resto (incluido \r, \n o \t inicial) es texto
+            if command_bytes and _OP_VALVE <= command_bytes[0] <= _OP_RESET:
+                return self._process_binary_command(command_bytes)
 
-            if not parts or not parts[0]:
-                response = "ERR: No command"
+            # Todo en bytes: sin decode ni split, una sola copia en mayúsculas
+            command = command_bytes.strip().upper()
+            if DEBUG: print("BLE CMD:", command)
+            if not command:
+                return "ERR: No command"
 
-            elif parts[0] == "VALVE" and len(parts) == 2:
-                self.set_valve(parts[1] == "ON")
-            
-            elif parts[0] == "MOTOR" and len(parts) == 2:
-                self.set_motor(parts[1] == "ON")
-            
-            elif parts[0] == "SCHEDULE" and parts[1] == "SET" and len(parts) == 3:
-                response = self._process_schedule_command(parts[2])
-            
-            elif parts[0] == "STATUS":
-                # Notificar el estado y no enviar respuesta de control.
-                self.notify_status()
-                return None
-            
-            elif parts[0] == "RESET_FLOW":
-                self.config_manager.save_log(0.0)
-                response = "OK: FLOW_TOTAL reset to 0.0"
-
-            else:
-                response = "ERR: Comando desconocido"
+            for prefix, handler in self._cmd_table:
+                if command.startswith(prefix):
+                    return handler(command[len(prefix):])
+            response = "ERR: Comando desconocido"
 
         except Exception as e:
-            response = f"ERR: Exception {e}"
-            print(f"❌ Error procesando comando BLE: {e}")
+            # Respuesta fija: una entrada malformada no debe generar cadenas nuevas en el heap
+            response = "ERR: Exception"
+            print("❌ Error procesando comando BLE:", e)
 
         return response
 
-    def notify_status(self):
-        """Prepara y envía la notificación de estado a través de BLE."""
+    def notify_status(self, force=False, t=None):
+        """Prepara y envía la notificación de estado a través de BLE.
+
+        Las notificaciones periódicas se omiten si el estado (sin contar la hora) no cambió
+        desde la última enviada; force=True (comando STATUS) envía siempre.
+        """
+        # Sin cliente conectado no hay a quién notificar: no formatear nada
+        if self.ble_controller.conn_handle is None:
+            return
         flow_liters_total = self.config_manager.flow_liters_total
-        current_hour, current_minute, current_second = self.get_current_time()
-        current_time_str = f"{current_hour:02d}:{current_minute:02d}:{current_second:02d}"
-
-        status_msg = (
-            f"STATUS:"
-            f"TIME={current_time_str};"
-            f"VALVE={1 if self.valve_on else 0};"
-            f"MOTOR={1 if self.motor_on else 0};"
-            f"FLOW_TOTAL={flow_liters_total:.2f}L;"
-            f"SCHEDULE={1 if self.scheduled_run_active else 0}"
-        )
-        print(status_msg)
-        self.ble_controller.notify_status(status_msg)
+        # Estado comparable sin construir el mensaje; litros al centésimo, igual que %.2f
+        state = (self.valve_on, self.motor_on, int(flow_liters_total * 100), self.scheduled_run_active)
+        if not force and state == self._last_status:
+            return
+        self._last_status = state
+
+        if t is None:
+            t = self.get_current_time()
+        status_msg = self._STATUS_FMT % (
+            t[3], t[4], t[5], self.valve_on, self.motor_on, flow_liters_total, self.scheduled_run_active)
+        if DEBUG: print(status_msg)
+        self._enqueue((_JOB_NOTIFY, status_msg))
 
     # ----------------------------------------------------------------------
     # --- Bucle Principal de Control ---
     # ----------------------------------------------------------------------
 # Modificación en la clase SystemController.main_loop
 
+    def _on_tick(self, timer):
+        """Callback del Timer de hardware (1 Hz): solo marca que paso un segundo."""
+        self._tick = True
+
     def main_loop(self):
         """Bucle principal que maneja la lógica de tiempo, programación y auto-apagado."""
         global current_second
-        last_second = -1
         last_save_time = time.time()
         
         # === AÑADIR NUEVA VARIABLE DE TIEMPO ===
         last_notify_time = time.time() 
         # ======================================
 
+        # Timer periódico de hardware: el bucle trabaja una vez por segundo en lugar de 100
+        self._tick = False
+        self._timer = Timer(0)
+        self._timer.init(period=_TICK_MS, mode=Timer.PERIODIC, callback=self._on_tick)
+
+        # Referencias locales para evitar búsquedas de atributos en cada tick
+        cm = self.config_manager
+        ble = self.ble_controller
+        read_pulses = self.flow_sensor.read_and_reset_pulses
+        calc_flow = self.flow_sensor.calculate_flow
+        get_time = self.get_current_time
+        enqueue = self._enqueue
+
+        # Minuto ya evaluado para la programación (-1: ninguno todavía)
+        last_minute = -1
+
         print("--- Entrando al bucle principal de control ---")
+        next_tick = time.ticks_add(time.ticks_ms(), _TICK_MS)
 
         while True:
             try:
+                if not self._tick:
+                    # Dormir hasta el próximo tick previsto: una sola espera por segundo, CPU libre para BLE
+                    wait = time.ticks_diff(next_tick, time.ticks_ms())
+                    # Si el Timer viene atrasado, reintentar en pasos cortos en vez de cada 1 ms
+                    time.sleep_ms(wait if wait > 0 else _TICK_LATE_MS)
+                    continue
+                self._tick = False
+                # Resincronizar con el tick real del Timer: tras un error o un tick largo no queda en el pasado
+                next_tick = time.ticks_add(time.ticks_ms(), _TICK_MS)
+
                 # Obtener la hora local (con offset de zona horaria)
-                current_hour, current_minute, current_second = self.get_current_time()
+                t = get_time()
+                current_hour, current_minute, current_second = t[3], t[4], t[5]
                 current_timestamp = time.time()
                 # Lógica que se ejecuta cada segundo
-                if current_second != last_second:
-                    last_second = current_second
-                
                 # 1. Calular Flujo y Acumulación
-                    pulses = self.flow_sensor.read_and_reset_pulses()
-                    flow_rate_lpm, liters_added = self.flow_sensor.calculate_flow(pulses, seconds_passed=1)
-                    self.config_manager.flow_liters_total += liters_added
+                pulses = read_pulses()
+                flow_rate_lpm, liters_added = calc_flow(pulses, 1)
+                cm.flow_liters_total += liters_added
+                
+                # 2. Persistencia del Log de Agua (cada 60 segundos)
+                if current_timestamp - last_save_time >= _LOG_SAVE_INTERVAL:
+                    enqueue((_JOB_SAVE, cm.flow_liters_total))
+                    last_save_time = current_timestamp
+                    #print(".")
                     
-                    # 2. Persistencia del Log de Agua (cada 60 segundos)
-                    if current_timestamp - last_save_time >= 60:
-                        self.config_manager.save_log(self.config_manager.flow_liters_total)
-                        last_save_time = current_timestamp
-                        #print(".")
-                        
-                    # 3. Lógica de Activación Programada (solo si la válvula está OFF)
-                    if not self.valve_on:
-                        current_time = [current_hour, current_minute]
-                        # Comprueba si la hora actual coincide con alguna programada (y es el segundo 0)
-                        if current_time in self.scheduled_times and current_second == 0:
-                            self.set_valve(True)
-                            if self.valve_on:
-                                self.scheduled_run_active = True
-                                self.flow_stop_timer_start = 0 
-                                print("🤖 Evento programado activado.")
-                                
-                    # 4. Lógica de Auto-Apagado por Falta de Flujo (Shutoff)
-                    if self.valve_on and self.scheduled_run_active:
-                        if flow_rate_lpm < 0.01: # Si el flujo es virtualmente cero
-                            if self.flow_stop_timer_start == 0:
-                                self.flow_stop_timer_start = current_timestamp
-                                print("⚠️ Flujo detectado como CERO. Iniciando conteo de apagado.")
-                                
-                            elif (current_timestamp - self.flow_stop_timer_start) >= self.flow_stop_timeout:
-                                self.set_valve(False) # Esto desactiva scheduled_run_active
-                                self.flow_stop_timer_start = 0
-                                print(f"🛑 Apagado automático: Flujo cero por más de {self.flow_stop_timeout} segundos.")
-                                
-                        else:
-                            # Flujo detectado, reinicia el timer
-                            if self.flow_stop_timer_start != 0:
-                                self.flow_stop_timer_start = 0
-                                print("✅ Flujo reestablecido. Reiniciando monitoreo de apagado.")
+                # 3. Lógica de Activación Programada (solo si la válvula está OFF)
+                # Se evalúa al cambiar de minuto: un tick atrasado puede saltarse el segundo 0
+                if current_minute != last_minute:
+                    last_minute = current_minute
+                    if not self.valve_on and current_hour * 60 + current_minute in self._scheduled_set:
+                        self.set_valve(True)
+                        if self.valve_on:
+                            self.scheduled_run_active = True
+                            self.flow_stop_timer_start = 0 
+                            print("🤖 Evento programado activado.")
+                            
+                # 4. Lógica de Auto-Apagado por Falta de Flujo (Shutoff)
+                if self.valve_on and self.scheduled_run_active:
+                    if flow_rate_lpm < 0.01: # Si el flujo es virtualmente cero
+                        if self.flow_stop_timer_start == 0:
+                            self.flow_stop_timer_start = current_timestamp
+                            if DEBUG: print("⚠️ Flujo detectado como CERO. Iniciando conteo de apagado.")
+                            
+                        elif (current_timestamp - self.flow_stop_timer_start) >= self.flow_stop_timeout:
+                            self.set_valve(False) # Esto desactiva scheduled_run_active
+                            self.flow_stop_timer_start = 0
+                            print(f"🛑 Apagado automático: Flujo cero por más de {self.flow_stop_timeout} segundos.")
+                            
+                    else:
+                        # Flujo detectado, reinicia el timer
+                        if self.flow_stop_timer_start != 0:
+                            self.flow_stop_timer_start = 0
+                            if DEBUG: print("✅ Flujo reestablecido. Reiniciando monitoreo de apagado.")
                 
                 # --- Lógica de Notificación de Estado (Fuera del chequeo de 'last_second') ---
-                if self.ble_controller.conn_handle is not None:
+                if ble.conn_handle is not None:
                     # Comprueba si han pasado 5 segundos desde la última notificación
-                    if current_timestamp - last_notify_time >= 5:
-                        print("-")
-                        self.notify_status()
+                    if current_timestamp - last_notify_time >= _NOTIFY_INTERVAL:
+                        if DEBUG: print("-")
+                        self.notify_status(t=t)
                         last_notify_time = current_timestamp # Reiniciar el contador
-                        
-                time.sleep(0.01) # Pequeña espera para no monopolizar el ciclo
-                gc.collect()
+                else:
+                    # Sin cliente: el próximo que se conecte debe recibir el estado completo
+                    self._last_status = None
 
             except Exception as e:
                 print(f"❌ Error CRÍTICO en el bucle de control: {e}")
                 time.sleep(5)
+                # Única recolección explícita: liberar lo que dejó el error antes de seguir
                 gc.collect()
 # ----------------------------------------------------------------------
 # --- PUNTO DE ENTRADA ---
@@ -4,6 +4,13 @@ import ujson
 import machine
 import os
 import gc
+import hashlib
+import binascii
+
+def _parse_version(v):
+    """'1.10.2' -> (1, 10, 2): compara bien versiones de varios dígitos y de 3 partes."""
+    # Los version.json viejos tienen un número (1.2): str() lo deja como '1.2'
+    return tuple(int(x) for x in str(v).split('.'))
 
 class OTAUpdater:
     def __init__(self, github_url, main_file='main.py'):
@@ -11,6 +18,9 @@ class OTAUpdater:
         self.github_url = github_url if github_url.endswith('/') else github_url + '/'
         self.http_host = self.github_url.replace('https://', '').replace('http://', '').split('/')[0]
         self.main_file = main_file
+        # Partes fijas de cada petición, armadas una sola vez
+        self._url_prefix = 'https://' + self.http_host
+        self._req_tail = b" HTTP/1.1\r\nHost: " + self.http_host.encode() + b"\r\nUser-Agent: MicroPython\r\nConnection: keep-alive\r\n"
         
         # URLs de control
         self.version_url = self.github_url + 'version.json'
@@ -19,115 +29,384 @@ class OTAUpdater:
         # Paths locales (con barra final para evitar errores de concatenación)
         self.update_folder = 'update/'
         self.current_version_file = 'version.json'
+        self.etags_file = 'etags.json'
+        self.ok_marker = '.ok' # en update/: la descarga terminó completa
 
-    def _http_get_stream(self, url, dest_path):
-        """Descarga un archivo vía HTTPS y lo escribe directamente en flash."""
+        # Conexión TLS persistente (keep-alive) para todos los GET de la actualización
+        self._sock = None
+        self._addr = None
+        # Buffer de 4 KB (bloque de LittleFS) para toda la actualización: descarga, hash y copia.
+        # Se reserva al inicio, con el heap recién compactado, para no fragmentarlo después
         gc.collect()
-        url_path = url.replace(f'https://{self.http_host}', '')
-        addr = usocket.getaddrinfo(self.http_host, 443)[0][-1]
-        s = usocket.socket()
-        
+        self._rxbuf = bytearray(4096)
+        self._rxmv = memoryview(self._rxbuf)
+        # Contexto TLS armado una sola vez (firmware con ssl.SSLContext); si no, wrap_socket del módulo
         try:
-            s.connect(addr)
-            s = ussl.wrap_socket(s, server_hostname=self.http_host)
-            # Solicitud HTTP 1.0 para evitar chunked encoding complejo
-            request = f"GET {url_path} HTTP/1.0\r\nHost: {self.http_host}\r\nUser-Agent: MicroPython\r\n\r\n"
-            s.send(request.encode())
-
-            # 1. Saltar encabezados buscando la línea vacía (\r\n\r\n)
-            while True:
-                line = s.readline()
-                if not line or line == b'\r\n':
+            self._ssl_ctx = ussl.SSLContext(ussl.PROTOCOL_TLS_CLIENT)
+            # Igual que wrap_socket(): sin verificar el certificado (no hay CA cargada)
+            self._ssl_ctx.verify_mode = ussl.CERT_NONE
+        except AttributeError:
+            self._ssl_ctx = None
+
+    def _connect(self):
+        """Abre (una sola vez) la conexión TLS al host; se reutiliza entre descargas."""
+        if self._sock is None:
+            if self._addr is None:
+                # DNS una sola vez por actualización (al primer uso, no en __init__ por si no hay red)
+                self._addr = usocket.getaddrinfo(self.http_host, 443)[0][-1]
+            s = usocket.socket()
+            try:
+                s.connect(self._addr)
+                wrap = self._ssl_ctx.wrap_socket if self._ssl_ctx else ussl.wrap_socket
+                s = wrap(s, server_hostname=self.http_host)
+            except Exception:
+                s.close()
+                raise
+            self._sock = s
+        return self._sock
+
+    def _close(self):
+        """Cierra la conexión persistente si está abierta."""
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except Exception:
+                pass
+            self._sock = None
+
+    def _get_request(self, url, etag=None):
+        """Arma la petición GET (HTTP/1.1, keep-alive) para una URL del host; condicional si hay ETag."""
+        # Unir bytes: en MicroPython b"%s" % bytes inserta el repr (b'...'), no el contenido
+        path = url.replace(self._url_prefix, '').encode()
+        if etag:
+            return b"".join((b"GET ", path, self._req_tail, b"If-None-Match: ", etag.encode(), b"\r\n\r\n"))
+        return b"".join((b"GET ", path, self._req_tail, b"\r\n"))
+
+    def _request(self, url, etag=None, while_waiting=None):
+        """GET con keep-alive. Devuelve (socket, Content-Length, ETag); ver _read_head.
+
+        while_waiting se ejecuta una vez entre el envío y la respuesta (trabajo local en paralelo a la red).
+        """
+        request = self._get_request(url, etag)
+        for attempt in range(2):
+            s = self._connect()
+            line = None
+            try:
+                s.write(request)
+            except OSError:
+                s = None
+            if while_waiting:
+                while_waiting()
+                while_waiting = None
+            if s is not None:
+                try:
+                    line = s.readline()
+                except OSError:
+                    pass
+            if line:
+                break
+            # El servidor cerró la conexión reutilizada: reconectar una vez
+            self._close()
+            if attempt:
+                raise OSError("OTA: sin respuesta de " + self.http_host)
+        length, etag = self._read_head(s, line, url)
+        return s, length, etag
+
+    def _read_head(self, s, line, url):
+        """Valida la línea de estado ya leída y consume los encabezados.
+
+        Devuelve (Content-Length o -1 si el cuerpo termina al cerrar, ETag o None);
+        el largo es None en un 304 (sin cambios, sin cuerpo).
+        """
+        # Línea de estado: "HTTP/1.1 200 OK" o 304; cualquier otro código no es el archivo pedido
+        status = line.split(None, 2)
+        if len(status) < 2 or status[1] not in (b'200', b'304'):
+            self._close()
+            raise OSError("OTA: HTTP " + line.decode().strip() + " en " + url)
+
+        # Leer encabezados hasta la línea vacía, quedándonos con el largo del cuerpo y el ETag
+        not_modified = status[1] == b'304'
+        length = -1
+        etag = None
+        while True:
+            line = s.readline()
+            if not line or line == b'\r\n':
+                break
+            low = line.lower()
+            if low.startswith(b'etag:'):
+                etag = line[5:].strip().decode() # conservar mayúsculas y comillas tal cual
+            elif low.startswith(b'content-length:'):
+                length = int(low[15:])
+            elif low.startswith(b'transfer-encoding:') and b'chunked' in low:
+                self._close()
+                raise OSError("OTA: respuesta chunked no soportada")
+        # Un 304 nunca trae cuerpo, aunque anuncie Content-Length
+        return (None if not_modified else length), etag
+
+    def _read_body(self, s, remaining, dest_path):
+        """Escribe en flash el cuerpo de la respuesta en curso; True si llegó completo."""
+        buf, mv = self._rxbuf, self._rxmv
+        size = len(buf)
+        filled = 0
+        with open(dest_path, 'wb') as f:
+            while remaining:
+                # readinto puede devolver menos (un registro TLS): juntar hasta llenar el bloque
+                want = size - filled if remaining < 0 else min(size - filled, remaining)
+                n = s.readinto(mv[filled:], want)
+                if not n:
                     break
-            
-            # 2. Escribir el cuerpo directamente al archivo en bloques de 512 bytes
-            with open(dest_path, 'wb') as f:
-                while True:
-                    data = s.recv(512)
-                    if not data:
-                        break
-                    f.write(data)
-            return True
+                filled += n
+                if remaining > 0:
+                    remaining -= n
+                if filled == size:
+                    # Escribir a flash solo bloques completos de 4 KB
+                    f.write(buf)
+                    filled = 0
+            if filled:
+                f.write(mv[:filled])
+        if remaining:
+            # Sin Content-Length (o cuerpo incompleto): la conexión no se puede reutilizar
+            self._close()
+        if remaining > 0:
+            # Llegaron menos bytes que el Content-Length: no dejar un archivo truncado en flash
+            print(f"❌ {dest_path} incompleto: faltan {remaining} bytes.")
+            try:
+                os.remove(dest_path)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def _store(self, s, length, etag, dest_path, sent_etag):
+        """Guarda la respuesta en curso. Devuelve el ETag a recordar ('' si no hay) o None si falló."""
+        if length is None:
+            # 304: el archivo instalado sigue vigente, no se escribe nada
+            print("⏭️ Sin cambios en el servidor.")
+            return etag or sent_etag
+        return (etag or '') if self._read_body(s, length, dest_path) else None
+
+    def _http_get_stream(self, url, dest_path, etag=None):
+        """Descarga un archivo vía HTTPS y lo escribe directamente en flash (ver _store)."""
+        gc.collect()
+        try:
+            s, length, new_etag = self._request(url, etag)
+            return self._store(s, length, new_etag, dest_path, etag)
         except Exception as e:
             print(f"❌ Error en stream HTTP: {e}")
-            return False
+            self._close()
+            return None
         finally:
-            s.close()
             gc.collect()
 
-    def _get_json_rpc(self, url):
+    def _get_json_rpc(self, url, while_waiting=None):
         """Método auxiliar para leer JSON pequeños (version/files) en RAM."""
-        url_path = url.replace(f'https://{self.http_host}', '')
-        addr = usocket.getaddrinfo(self.http_host, 443)[0][-1]
-        s = usocket.socket()
         try:
-            s.connect(addr)
-            s = ussl.wrap_socket(s, server_hostname=self.http_host)
-            s.send(f"GET {url_path} HTTP/1.0\r\nHost: {self.http_host}\r\n\r\n".encode())
-            
-            while True:
-                line = s.readline()
-                if not line or line == b'\r\n': break
-            
-            content = s.read().decode('utf-8')
-            return ujson.loads(content)
-        finally:
-            s.close()
+            s, length, _ = self._request(url, while_waiting=while_waiting)
+            if length < 0:
+                # Cuerpo hasta el cierre: parsear directo desde el socket
+                data = ujson.load(s)
+                self._close()
+                return data
+            # Leer exactamente el cuerpo para dejar la conexión lista para el siguiente GET
+            return ujson.loads(s.read(length))
+        except Exception:
+            self._close()
+            raise
 
     def check_for_updates(self):
         """Compara versiones."""
         try:
             remote_data = self._get_json_rpc(self.version_url)
-            remote_v = float(remote_data['version'])
+            remote_v = remote_data['version']
             
-            local_v = 0.0
-            if self.current_version_file in os.listdir():
+            local_v = '0'
+            try:
                 with open(self.current_version_file, 'r') as f:
-                    local_v = float(ujson.load(f)['version'])
+                    local_v = ujson.load(f)['version']
+            except OSError:
+                pass # primera instalación: sin version.json local
             
             print(f"OTA: Local {local_v} | Remota {remote_v}")
-            return remote_v > local_v
+            if _parse_version(remote_v) > _parse_version(local_v):
+                # Mantener la conexión abierta para download_updates
+                return True
+            self._close()
+            return False
         except Exception as e:
             print(f"OTA: No se pudo verificar versión: {e}")
+            self._close()
             return False
 
+    def _file_sha1(self, path):
+        """SHA-1 (hex) de un archivo local en bloques de 4 KB; None si no existe."""
+        h = hashlib.sha1()
+        buf, mv = self._rxbuf, self._rxmv
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    n = f.readinto(buf)
+                    if not n: break
+                    h.update(mv[:n])
+        except OSError:
+            return None
+        return binascii.hexlify(h.digest()).decode()
+
+    def _clean_update_folder(self):
+        """Borra restos de una descarga anterior (update/ y update.old/)."""
+        # Primero ocultar update/ con un rename atómico: si se corta la luz a mitad de la
+        # limpieza no queda un update/ a medio borrar que luego se instale.
+        # Dos pasadas: si ya quedaba un update.old/ de antes, el primer rename falla
+        for _ in range(2):
+            try:
+                os.rename('update', 'update.old')
+            except OSError:
+                pass
+            try:
+                for file in os.listdir('update.old'):
+                    os.remove('update.old/' + file)
+                os.rmdir('update.old')
+            except OSError:
+                pass
+
+    def _load_etags(self):
+        """ETag de cada archivo instalado (etags.json); vacío si no hay."""
+        try:
+            with open(self.etags_file, 'r') as f:
+                return ujson.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _prepare_update_folder(self):
+        """Deja un update/ vacío listo para recibir la descarga."""
+        self._clean_update_folder()
+        os.mkdir('update')
+
     def download_updates(self):
         """Descarga todos los archivos definidos en files.json."""
         try:
-            if 'update' not in os.listdir():
-                os.mkdir('update')
-            
-            files_data = self._get_json_rpc(self.files_url)
-            for filename in files_data['files']:
-                print(f"📥 Descargando {filename}...")
-                self._http_get_stream(self.github_url + filename, self.update_folder + filename)
-            
-            # También descargar el nuevo version.json
-            self._http_get_stream(self.version_url, self.update_folder + self.current_version_file)
+            # Pedir files.json y, mientras llega la respuesta, dejar update/ vacío
+            # (sin archivos de un intento previo interrumpido)
+            files_data = self._get_json_rpc(self.files_url, self._prepare_update_folder)
+            etags = self._load_etags()
+            # Archivos del manifiesto (salvo los que ya están iguales) y, al final, el nuevo version.json
+            pending = []
+            for entry in files_data['files']:
+                # Entrada: "nombre" o {"name": "nombre", "sha1": "hex"}
+                if isinstance(entry, dict):
+                    name = entry['name']
+                    if entry.get('sha1') and self._file_sha1(name) == entry['sha1']:
+                        print(f"⏭️ {name} sin cambios.")
+                        continue
+                else:
+                    name = entry
+                # GET condicional solo si el archivo sigue instalado (un 304 no lo repondría)
+                try:
+                    os.stat(name)
+                    sent = etags.get(name)
+                except OSError:
+                    sent = None
+                pending.append((self.github_url + name, self.update_folder + name, name, sent))
+            pending.append((self.version_url, self.update_folder + self.current_version_file, None, None))
+
+            # Pipelining: enviar todos los GET de una vez y leer las respuestas en orden
+            pipelined = True
+            try:
+                self._connect().write(b"".join(self._get_request(url, sent) for url, _, _, sent in pending))
+            except OSError:
+                self._close()
+                pipelined = False
+            new_etags = dict(etags)
+            complete = True
+            for url, dest, name, sent in pending:
+                print(f"📥 Descargando {dest[len(self.update_folder):]}...")
+                gc.collect()
+                result = None
+                # Sin tubería, self._sock es la conexión de _http_get_stream, que no tiene
+                # peticiones pendientes: leer de ella bloquearía hasta que el servidor la cierre
+                s = self._sock if pipelined else None
+                if s is not None:
+                    try:
+                        line = s.readline()
+                        if line:
+                            length, etag = self._read_head(s, line, url)
+                            result = self._store(s, length, etag, dest, sent)
+                    except OSError:
+                        pass
+                    if result is None:
+                        # Se cortó la tubería: el resto se pide de a uno
+                        self._close()
+                        pipelined = False
+                    elif self._sock is None:
+                        # Respuesta sin Content-Length: _read_body cerró la conexión con la tubería
+                        pipelined = False
+                if result is None:
+                    result = self._http_get_stream(url, dest, sent)
+                    if result is None:
+                        complete = False
+                # Si falló, el archivo instalado no cambió y su ETag sigue valiendo
+                if name and result is not None:
+                    if result:
+                        new_etags[name] = result
+                    else:
+                        new_etags.pop(name, None)
+
+            # etags.json se instala después de todos los archivos (ver install_updates): si la
+            # instalación se corta antes, el próximo intento manda los ETag viejos y vuelve a descargar
+            if new_etags != etags:
+                with open(self.update_folder + self.etags_file, 'w') as f:
+                    ujson.dump(new_etags, f)
+            if not complete:
+                print("⚠️ Descarga incompleta: no se instalará.")
+                return False
+            # Marca escrita al final: solo una descarga completa se puede instalar
+            open(self.update_folder + self.ok_marker, 'w').close()
             return True
         except Exception as e:
             print(f"❌ Error descargando actualización: {e}")
             return False
+        finally:
+            self._close()
 
     def install_updates(self):
-        """Instala los archivos moviéndolos a la raíz."""
+        """Instala los archivos moviéndolos a la raíz (rename; copia si falla)."""
         try:
-            for file in os.listdir('update'):
+            try:
+                os.stat(self.update_folder + self.ok_marker)
+            except OSError:
+                print("⚠️ No hay una descarga completa para instalar.")
+                return False
+            # Primero los archivos de datos; después etags.json y por último version.json. Si se corta
+            # la luz a mitad, la versión local y los ETag siguen siendo los viejos y el próximo
+            # arranque vuelve a descargar (sin 304) e instalar todo
+            last = (self.etags_file, self.current_version_file)
+            staged = os.listdir('update')
+            files = [f for f in staged if f != self.ok_marker and f not in last]
+            files.extend(f for f in last if f in staged)
+            buf, mv = self._rxbuf, self._rxmv
+            for file in files:
                 source = self.update_folder + file
                 print(f"🔧 Instalando {file}...")
-                
-                # Operación de reemplazo segura
-                if file in os.listdir():
+
+                # Rename: solo metadatos y atómico en LittleFS (reemplaza el archivo existente)
+                try:
+                    os.rename(source, file)
+                    continue
+                except OSError:
+                    pass
+
+                # Respaldo: borrar y copiar (en MicroPython os.rename a veces falla entre carpetas)
+                try:
                     os.remove(file)
-                
-                # Leemos y escribimos (en MicroPython os.rename a veces falla entre carpetas)
+                except OSError:
+                    pass # no existía
                 with open(source, 'rb') as src, open(file, 'wb') as dst:
                     while True:
-                        buf = src.read(512)
-                        if not buf: break
-                        dst.write(buf)
+                        n = src.readinto(buf)
+                        if not n: break
+                        dst.write(mv[:n])
                 os.remove(source)
 
+            os.remove(self.update_folder + self.ok_marker)
             os.rmdir('update')
             print("✅ Actualización instalada. Reiniciando...")
             machine.reset()